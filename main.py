@@ -1,40 +1,72 @@
 import hashlib
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, HTTPException, Request
 from decouple import config
 from typing import Union
 
 from tools import CodeReviewService
 from schemas import ReviewRequest, ReviewResponseModel
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.http_client = CodeReviewService.create_http_client()
+    app.state.crs = CodeReviewService(app.state.http_client)
+    try:
+        yield
+    finally:
+        await app.state.http_client.aclose()
+        await CodeReviewService.redis_client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+def get_crs(request: Request) -> CodeReviewService:
+    return request.app.state.crs
 
 
 @app.post("/review", response_model=ReviewResponseModel)
-async def create_review(review: ReviewRequest) -> Union[ReviewResponseModel, dict]:
-    code_review_service = CodeReviewService()
+async def create_review(
+    review: ReviewRequest,
+    code_review_service: CodeReviewService = Depends(get_crs),
+) -> Union[ReviewResponseModel, dict]:
     url_parts = review.github_repo_url.path.strip("/").split("/")
     if len(url_parts) < 2:
         raise HTTPException(status_code=400, detail="Invalid GitHub repository URL.")
     owner, repo = url_parts[0], url_parts[1]
-    search_string = f"{str(review.github_repo_url)} {review.candidate_level}"
-    cache_key = hashlib.md5(search_string.encode()).hexdigest()
+    head_sha = await code_review_service.get_head_sha(owner, repo)
+    search_string = "|".join(
+        [
+            str(review.github_repo_url),
+            review.candidate_level.value,
+            review.assignment_description,
+            head_sha,
+        ]
+    )
+    cache_key = (
+        f"review:{review.candidate_level.value}:{owner}:{repo}:{head_sha[:12]}:"
+        f"{hashlib.sha256(search_string.encode()).hexdigest()}"
+    )
 
-    cached_result = code_review_service.get_cached_result(cache_key)
+    cached_result = await code_review_service.get_cached_result(cache_key)
     if cached_result:
         return cached_result
 
-    files_content = await code_review_service.fetch_all_files_content(owner, repo)
+    files_content = await code_review_service.fetch_all_files_content(
+        owner, repo, head_sha
+    )
     review_response = await code_review_service.generate_review(
         files_content, review.candidate_level
     )
-    code_review_service.cache_result(
+    await code_review_service.cache_result(
         cache_key,
         (
             review_response
             if isinstance(review_response, dict)
-            else review_response.dict()
+            else review_response.model_dump()
         ),
-        ttl=3600,
+        ttl=CodeReviewService.REVIEW_CACHE_TTL,
     )
 
     return review_response
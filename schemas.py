@@ -1,4 +1,4 @@
-from pydantic import BaseModel, HttpUrl, RootModel
+from pydantic import BaseModel, ConfigDict, HttpUrl, RootModel
 from typing import Dict, Optional, Any
 from enum import Enum
 
@@ -21,11 +21,13 @@ class CandidateLevel(str, Enum):
 
 
 class ReviewRequest(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     assignment_description: str = "GraphQL simple API"
     github_repo_url: HttpUrl = "https://github.com/t-s-e-z-a-r/GraphQL"
     candidate_level: CandidateLevel
 
     def to_dict(self):
-        data = self.dict()
+        data = self.model_dump()
         data["github_repo_url"] = str(self.github_repo_url)
         return data
@@ -1,15 +1,32 @@
+import asyncio
+import httpx
+import orjson
 import pytest
+import re
+import time
+import zstandard as zstd
 from httpx import AsyncClient
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, AsyncMock, MagicMock, PropertyMock
 from fastapi import HTTPException
 import hashlib
 from main import app
-from schemas import ReviewRequest
+from schemas import ReviewRequest, ReviewResponseModel
+from tools import GRAPHQL_TREE_QUERY, CodeReviewService
+from vertexai.generative_models import FinishReason
+
+
+@pytest.fixture(autouse=True)
+def mock_head_sha():
+    with patch("tools.CodeReviewService.get_head_sha") as mock_get_head_sha:
+        mock_get_head_sha.return_value = "0123456789abcdef0123456789abcdef01234567"
+        yield mock_get_head_sha
 
 
 @pytest.fixture
 async def client():
-    async with AsyncClient(app=app, base_url="http://testserver") as client:
+    async with app.router.lifespan_context(app), AsyncClient(
+        app=app, base_url="http://testserver"
+    ) as client:
         yield client
 
 
@@ -21,7 +38,9 @@ async def test_create_review_success(client):
         assignment_description="Test task",
     )
 
-    with patch("tools.CodeReviewService.redis_client") as mock_redis, patch(
+    with patch(
+        "tools.CodeReviewService.redis_client", new_callable=AsyncMock
+    ) as mock_redis, patch(
         "tools.CodeReviewService.fetch_all_files_content"
     ) as mock_fetch_files, patch(
         "tools.CodeReviewService.generate_review"
@@ -60,7 +79,9 @@ async def test_create_review_github_error(client):
 
     with patch(
         "tools.CodeReviewService.fetch_all_files_content"
-    ) as mock_fetch_files, patch("tools.CodeReviewService.redis_client") as mock_redis:
+    ) as mock_fetch_files, patch(
+        "tools.CodeReviewService.redis_client", new_callable=AsyncMock
+    ) as mock_redis:
         mock_fetch_files.side_effect = HTTPException(
             status_code=404, detail="Repository not found."
         )
@@ -126,7 +147,7 @@ async def test_create_review_empty_repo(client):
     ) as mock_fetch_files, patch(
         "tools.CodeReviewService.generate_review",
     ) as mock_generate_review, patch(
-        "tools.CodeReviewService.redis_client"
+        "tools.CodeReviewService.redis_client", new_callable=AsyncMock
     ) as mock_redis:
         mock_redis.get.return_value = None
         mock_fetch_files.return_value = {}
@@ -160,7 +181,7 @@ async def test_create_review_model_generation_error(client):
     ) as mock_fetch_files, patch(
         "tools.CodeReviewService.generate_review"
     ) as mock_generate_review, patch(
-        "tools.CodeReviewService.redis_client"
+        "tools.CodeReviewService.redis_client", new_callable=AsyncMock
     ) as mock_redis:
 
         mock_redis.get.return_value = None
@@ -174,3 +195,447 @@ async def test_create_review_model_generation_error(client):
 
         assert response.status_code == 500
         assert response.json() == {"detail": "Model generation error."}
+
+
+def graphql_handler(tree_entries, blob_objects, requested_oids):
+    def handle(request: httpx.Request) -> httpx.Response:
+        query = orjson.loads(request.content)["query"]
+        oids = re.findall(r'object\(oid: "(\w+)"\)', query)
+        if not oids:
+            return httpx.Response(
+                200,
+                json={"data": {"repository": {"object": {"entries": tree_entries}}}},
+            )
+        requested_oids.extend(oids)
+        return httpx.Response(
+            200,
+            json={
+                "data": {
+                    "repository": {
+                        f"b{index}": blob_objects[oid] for index, oid in enumerate(oids)
+                    }
+                }
+            },
+        )
+
+    return handle
+
+
+def mget_from(cached_blobs):
+    def mget(*keys):
+        if isinstance(keys[0], list):
+            return [
+                (
+                    zstd.ZstdCompressor().compress(cached_blobs[key])
+                    if key in cached_blobs
+                    else None
+                )
+                for key in keys[0]
+            ]
+        return [None, None]
+
+    return mget
+
+
+@pytest.mark.asyncio
+async def test_fetch_all_files_content_graphql_with_rest_fallback():
+    tree_entries = [
+        {"path": "main.py", "type": "blob", "oid": "a1", "object": {}},
+        {"path": "logo.png", "type": "blob", "oid": "a2", "object": {}},
+        {"path": "big.bin", "type": "blob", "oid": "a3", "object": {"isBinary": True}},
+        {"path": "deep", "type": "tree", "oid": "t1", "object": {}},
+        {"path": "other", "type": "tree", "oid": "t3", "object": {}},
+        {
+            "path": "node_modules",
+            "type": "tree",
+            "oid": "t9",
+            "object": {
+                "entries": [{"path": "node_modules/x.js", "type": "blob", "oid": "n1"}]
+            },
+        },
+    ]
+    blob_objects = {
+        "a1": {"text": "print('hi')", "isBinary": False, "isTruncated": False},
+        "b1": {"text": "x =", "isBinary": False, "isTruncated": True},
+        "b4": {"text": None, "isBinary": False, "isTruncated": True},
+    }
+    requested_oids = []
+    handle_graphql = graphql_handler(tree_entries, blob_objects, requested_oids)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/graphql":
+            return handle_graphql(request)
+        if request.url.path.endswith("/git/trees/t1"):
+            return httpx.Response(
+                200,
+                json={
+                    "tree": [
+                        {"path": "mod.py", "type": "blob", "sha": "b1"},
+                        {"path": "pkg", "type": "tree", "sha": "t2"},
+                    ]
+                },
+            )
+        if request.url.path.endswith("/git/trees/t3"):
+            return httpx.Response(
+                200,
+                json={
+                    "tree": [
+                        {"path": "cfg.py", "type": "blob", "sha": "b1"},
+                        {"path": "font.woff2", "type": "blob", "sha": "b4"},
+                    ]
+                },
+            )
+        if request.url.path.endswith("/git/blobs/b1"):
+            assert request.headers["Accept"] == "application/vnd.github.raw"
+            return httpx.Response(200, text="x = 1")
+        if request.url.path.endswith("/git/blobs/b4"):
+            return httpx.Response(200, content=b"wOF2\x00\x01\x02")
+        return httpx.Response(404)
+
+    with patch("tools.GenerativeModel", MagicMock()), patch(
+        "tools.CodeReviewService.redis_client", new_callable=AsyncMock
+    ) as mock_redis:
+        mock_redis.mget.side_effect = mget_from({})
+        async with AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+            service = CodeReviewService(http_client)
+            files_content = await service.fetch_all_files_content("owner", "repo")
+
+    assert files_content == {
+        "main.py": "print('hi')",
+        "big.bin": None,
+        "deep/mod.py": "x = 1",
+        "other/cfg.py": "x = 1",
+        "other/font.woff2": None,
+    }
+    assert "text" not in GRAPHQL_TREE_QUERY
+    assert sorted(requested_oids) == ["a1", "b1", "b4"]
+    assert {call.args[0] for call in mock_redis.set.await_args_list} == {
+        "blob:a1",
+        "blob:b1",
+    }
+
+
+@pytest.mark.asyncio
+async def test_fetch_all_files_content_fetches_only_uncached_blobs():
+    tree_entries = [
+        {"path": name, "type": "blob", "oid": sha, "object": {}}
+        for name, sha in [("a.py", "b1"), ("b.py", "b2"), ("c.py", "b3")]
+    ]
+    blob_objects = {"b2": {"text": "fetched", "isBinary": False, "isTruncated": False}}
+    requested_oids = []
+    handler = graphql_handler(tree_entries, blob_objects, requested_oids)
+
+    with patch("tools.GenerativeModel", MagicMock()), patch(
+        "tools.CodeReviewService.redis_client", new_callable=AsyncMock
+    ) as mock_redis:
+        mock_redis.mget.side_effect = mget_from(
+            {"blob:b1": b"cached a", "blob:b3": b"cached c"}
+        )
+        async with AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+            service = CodeReviewService(http_client)
+            files_content = await service.fetch_all_files_content("owner", "repo")
+
+    assert files_content == {"a.py": "cached a", "b.py": "fetched", "c.py": "cached c"}
+    assert requested_oids == ["b2"]
+    mock_redis.mget.assert_any_await(["blob:b1", "blob:b2", "blob:b3"])
+    mock_redis.get.assert_not_called()
+
+
+def test_parse_review_response_extracts_sections():
+    response_text = (
+        "### Start of Review\n"
+        "### Downsides:\n- No tests.\n- Hardcoded config.\n\n"
+        "### Rating:\n3/5\n"
+        "### Conclusion:\nSolid start.\n"
+        "### End of Review"
+    )
+
+    review = CodeReviewService.parse_review_response(response_text, {"main.py": None})
+
+    assert review.downsides_comments == "- No tests.\n- Hardcoded config."
+    assert review.rating == "3/5"
+    assert review.conclusion == "Solid start."
+    assert review.found_files.root == {"main.py": None}
+
+    review = CodeReviewService.parse_review_response(
+        "### Downsides:\n### Rating:\n4/5\n### Conclusion:\nok", {}
+    )
+
+    assert review.downsides_comments == ""
+    assert review.rating == "4/5"
+    assert review.conclusion == "ok"
+
+
+def test_build_file_structure_nests_paths():
+    file_tree = CodeReviewService.build_file_structure(
+        ["README.md", "src/app/app", "src/app/main.py", "src/utils.py"]
+    )
+
+    assert file_tree == {
+        "README.md": None,
+        "src": {"app": {"app": None, "main.py": None}, "utils.py": None},
+    }
+
+
+def test_batch_files_groups_by_directory_within_budget():
+    batches = CodeReviewService._batch_files(
+        {"b/x.py": "x" * 6, "a/y.py": "y" * 6, "b/z.py": "z" * 6, "a/w.py": None},
+        budget=12,
+    )
+
+    assert batches == [
+        {"a/y.py": "y" * 6, "a/w.py": None, "b/x.py": "x" * 6},
+        {"b/z.py": "z" * 6},
+    ]
+
+
+def test_merge_downsides_dedupes_whole_bullet_blocks():
+    def review(downsides):
+        return ReviewResponseModel(
+            found_files={}, downsides_comments=downsides, rating="", conclusion=""
+        )
+
+    merged = CodeReviewService._merge_downsides(
+        [
+            review("- No tests\n  - views.py\n  - models.py\n- Hardcoded secrets"),
+            review("- No tests\n  - views.py\n  - models.py\n- No README\n  see docs"),
+        ]
+    )
+
+    assert merged == (
+        "- No tests\n  - views.py\n  - models.py\n"
+        "- Hardcoded secrets\n"
+        "- No README\n  see docs"
+    )
+
+
+@pytest.mark.asyncio
+async def test_generate_review_merges_batches():
+    batch_response = (
+        "### Downsides:\n- {}\n- Shared issue\n### Rating:\n3/5\n### Conclusion:\nOk."
+    )
+    summary_response = "### Rating:\n3/5 overall\n### Conclusion:\nNeeds tests."
+
+    with patch("tools.GenerativeModel", MagicMock()):
+        service = CodeReviewService(MagicMock())
+    service.REVIEW_BATCH_BYTES = 10
+    service.model.generate_content_async = AsyncMock(
+        side_effect=[
+            MagicMock(text=batch_response.format("Issue in a")),
+            MagicMock(text=batch_response.format("Issue in b")),
+            MagicMock(text=summary_response),
+        ]
+    )
+
+    review = await service.generate_review(
+        {"a/main.py": "x" * 10, "b/util.py": "y" * 10}, "Junior"
+    )
+
+    assert service.model.generate_content_async.await_count == 3
+    batch_prompts = [
+        call.args[0] for call in service.model.generate_content_async.await_args_list
+    ]
+    assert "{'a': {'main.py': None}}" in batch_prompts[0]
+    assert "'b'" not in batch_prompts[0]
+    assert "{'b': {'util.py': None}}" in batch_prompts[1]
+    assert "{'a': {'main.py': None}, 'b': {'util.py': None}}" in batch_prompts[2]
+    assert review.downsides_comments == "- Issue in a\n- Shared issue\n- Issue in b"
+    assert review.rating == "3/5 overall"
+    assert review.conclusion == "Needs tests."
+    assert review.found_files.root == {"a": {"main.py": None}, "b": {"util.py": None}}
+
+
+@pytest.mark.asyncio
+async def test_generate_text_retries_on_safety_block():
+    blocked = MagicMock()
+    blocked.candidates[0].finish_reason = FinishReason.SAFETY
+    type(blocked).text = PropertyMock(side_effect=ValueError("blocked"))
+
+    with patch("tools.GenerativeModel", MagicMock()):
+        service = CodeReviewService(MagicMock())
+    service.model.generate_content_async = AsyncMock(
+        side_effect=[blocked, MagicMock(text="### Rating:\n4/5")]
+    )
+
+    with patch("tools.asyncio.sleep", AsyncMock()) as mock_sleep:
+        text = await service._generate_text("prompt")
+
+    assert text == "### Rating:\n4/5"
+    mock_sleep.assert_awaited_once_with(CodeReviewService.SAFETY_BACKOFF_FACTOR)
+
+
+@pytest.mark.asyncio
+async def test_github_requests_wait_for_shared_rate_limit_reset():
+    reset_time = int(time.time()) + 30
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(
+            200,
+            json={"sha": "abc"},
+            headers={
+                "X-RateLimit-Reset": str(reset_time + 3600),
+                "X-RateLimit-Remaining": "4999",
+                "X-RateLimit-Resource": "core",
+            },
+        )
+
+    with patch("tools.GenerativeModel", MagicMock()), patch(
+        "tools.CodeReviewService.redis_client", new_callable=AsyncMock
+    ) as mock_redis, patch("tools.asyncio.sleep", AsyncMock()) as mock_sleep:
+        mock_redis.mget.return_value = [str(reset_time).encode(), b"3"]
+        async with AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+            service = CodeReviewService(http_client)
+            commit = await service._request_json(
+                "GET", "https://api.github.com/repos/owner/repo/commits/HEAD", "Error"
+            )
+
+    assert commit == {"sha": "abc"}
+    mock_redis.mget.assert_awaited_once_with(
+        "gh:rate_reset:core", "gh:rate_remaining:core"
+    )
+    assert 0 < mock_sleep.await_args.args[0] <= 30
+    mock_redis.mset.assert_awaited_once_with(
+        {
+            "gh:rate_reset:core": str(reset_time + 3600),
+            "gh:rate_remaining:core": "4999",
+        }
+    )
+
+
+@pytest.mark.asyncio
+async def test_cache_result_round_trips_compressed_payload():
+    stored = {}
+
+    async def fake_set(key, value, ex=None):
+        stored[key] = value
+
+    async def fake_get(key):
+        return stored.get(key)
+
+    payload = {"found_files": {"main.py": None}, "rating": "4/5"}
+    with patch(
+        "tools.CodeReviewService.redis_client", new_callable=AsyncMock
+    ) as mock_redis:
+        mock_redis.set.side_effect = fake_set
+        mock_redis.get.side_effect = fake_get
+        await CodeReviewService.cache_result("review:key", payload, ttl=60)
+        cached = await CodeReviewService.get_cached_result("review:key")
+
+    assert stored["review:key"] != orjson.dumps(payload)
+    assert cached == payload
+
+
+@pytest.mark.asyncio
+async def test_generate_review_cancels_remaining_batches_on_failure():
+    cancelled = asyncio.Event()
+    in_flight = 0
+    max_in_flight = 0
+
+    async def fake_generate(prompt):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        try:
+            if "a/main.py" in prompt:
+                await asyncio.sleep(0)
+                raise RuntimeError("quota exceeded")
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        finally:
+            in_flight -= 1
+
+    with patch("tools.GenerativeModel", MagicMock()):
+        service = CodeReviewService(MagicMock())
+    service.REVIEW_BATCH_BYTES = 10
+    service.MAX_CONCURRENT_BATCH_REVIEWS = 2
+    service.model.generate_content_async = fake_generate
+
+    with pytest.raises(HTTPException) as exc_info:
+        await service.generate_review(
+            {"a/main.py": "x" * 10, "b/util.py": "y" * 10, "c/io.py": "z" * 10},
+            "Junior",
+        )
+
+    assert exc_info.value.status_code == 500
+    assert cancelled.is_set()
+    assert max_in_flight == 2
+
+
+@pytest.mark.asyncio
+async def test_create_review_cache_key_tracks_head_sha(client, mock_head_sha):
+    head_sha = mock_head_sha.return_value
+    review_data = ReviewRequest(
+        github_repo_url="https://github.com/testuser/testrepo",
+        candidate_level="Junior",
+        assignment_description="Test task",
+    )
+    review_result = {
+        "found_files": {"file1.py": None},
+        "downsides_comments": "No issues",
+        "rating": "5/5",
+        "conclusion": "Great job!",
+    }
+    search_string = "|".join(
+        ["https://github.com/testuser/testrepo", "Junior", "Test task", head_sha]
+    )
+    expected_key = (
+        f"review:Junior:testuser:testrepo:{head_sha[:12]}:"
+        f"{hashlib.sha256(search_string.encode()).hexdigest()}"
+    )
+
+    with patch(
+        "tools.CodeReviewService.get_cached_result", return_value=None
+    ) as mock_get_cache, patch(
+        "tools.CodeReviewService.cache_result"
+    ) as mock_set_cache, patch(
+        "tools.CodeReviewService.fetch_all_files_content",
+        return_value={"file1.py": "print('Hello World')"},
+    ) as mock_fetch_files, patch(
+        "tools.CodeReviewService.generate_review", return_value=review_result
+    ):
+        response = await client.post("/review", json=review_data.to_dict())
+
+    assert response.status_code == 200
+    mock_head_sha.assert_awaited_once_with("testuser", "testrepo")
+    mock_get_cache.assert_awaited_once_with(expected_key)
+    mock_fetch_files.assert_awaited_once_with("testuser", "testrepo", head_sha)
+    mock_set_cache.assert_awaited_once_with(
+        expected_key, review_result, ttl=CodeReviewService.REVIEW_CACHE_TTL
+    )
+
+
+@pytest.mark.asyncio
+async def test_request_json_only_waits_on_exhausted_rate_limit():
+    responses = [
+        httpx.Response(
+            403,
+            headers={
+                "X-RateLimit-Remaining": "0",
+                "X-RateLimit-Reset": str(int(time.time()) + 5),
+            },
+        ),
+        httpx.Response(200, json={"sha": "abc"}),
+        httpx.Response(403, json={"message": "Resource protected by SSO"}),
+    ]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return responses.pop(0)
+
+    with patch("tools.GenerativeModel", MagicMock()), patch(
+        "tools.CodeReviewService.redis_client", new_callable=AsyncMock
+    ) as mock_redis, patch("tools.asyncio.sleep", AsyncMock()) as mock_sleep:
+        mock_redis.mget.return_value = [None, None]
+        async with AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+            service = CodeReviewService(http_client)
+            url = "https://api.github.com/repos/owner/repo/commits/HEAD"
+            assert await service._request_json("GET", url, "Error") == {"sha": "abc"}
+            mock_sleep.assert_awaited_once()
+
+            with pytest.raises(HTTPException) as exc_info:
+                await service._request_json("GET", url, "Forbidden.")
+
+    assert exc_info.value.status_code == 403
+    assert exc_info.value.detail == "Forbidden."
+    mock_sleep.assert_awaited_once()
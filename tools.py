@@ -1,16 +1,17 @@
 import asyncio
-import base64
 import httpx
-import json
+import io
+import orjson
 import re
-import redis
 import time
 import vertexai
+import zstandard as zstd
 from decouple import config
+from redis.asyncio import Redis
 from fastapi import HTTPException
-from vertexai.generative_models import GenerativeModel
+from vertexai.generative_models import FinishReason, GenerativeModel
 from schemas import ReviewResponseModel, FileTreeModel
-from typing import Optional, Dict, Union
+from typing import Awaitable, Dict, Iterable, List, Optional, Tuple, TypeVar, Union
 import logging
 
 logging.basicConfig(
@@ -20,8 +21,59 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 github_token = config("GITHUB_TOKEN")
-project_id = (config("PROJECT_ID"),)
+project_id = config("PROJECT_ID")
+
+vertexai.init(project=project_id, location="us-central1")
+
+GITHUB_RAW_MEDIA_TYPE = "application/vnd.github.raw"
+GRAPHQL_URL = "https://api.github.com/graphql"
+GRAPHQL_TREE_DEPTH = 4
+GRAPHQL_BLOB_BATCH = 100
+
+SKIP_DIRS = {"node_modules", "dist", "build", ".git", "vendor", "__pycache__"}
+SKIP_EXT = (".png", ".jpg", ".jpeg", ".gif", ".ico", ".lock", ".min.js", ".map", ".pdf")
+
+_zstd_compressor = zstd.ZstdCompressor(level=3)
+_zstd_decompressor = zstd.ZstdDecompressor()
+
+TOP_LEVEL_BULLET_RE = re.compile(r"(?:[-*+]|\d+[.)])\s")
+
+REVIEW_SECTION_RE = re.compile(
+    r"### (?P<section>Downsides|Rating|Conclusion):\n(?P<body>.*?)(?=^###|\Z)",
+    re.MULTILINE | re.DOTALL,
+)
+
+
+def _build_tree_query(depth: int) -> str:
+    blob_fields = "... on Blob { isBinary }"
+    entries = f"entries {{ path type oid object {{ {blob_fields} }} }}"
+    for _ in range(depth - 1):
+        entries = (
+            f"entries {{ path type oid object {{ {blob_fields} "
+            f"... on Tree {{ {entries} }} }} }}"
+        )
+    return (
+        "query($owner: String!, $name: String!, $expression: String!) { "
+        "repository(owner: $owner, name: $name) { "
+        f"object(expression: $expression) {{ ... on Tree {{ {entries} }} }} }} }}"
+    )
+
+
+def _build_blob_text_query(oids: List[str]) -> str:
+    objects = " ".join(
+        f'b{index}: object(oid: "{oid}") {{ ... on Blob {{ text isBinary isTruncated }} }}'
+        for index, oid in enumerate(oids)
+    )
+    return (
+        "query($owner: String!, $name: String!) { "
+        f"repository(owner: $owner, name: $name) {{ {objects} }} }}"
+    )
+
+
+GRAPHQL_TREE_QUERY = _build_tree_query(GRAPHQL_TREE_DEPTH)
 
 
 class CodeReviewService:
@@ -31,50 +83,122 @@ class CodeReviewService:
     BACKOFF_FACTOR = 2
     SAFETY_RETRY_LIMIT = 3
     SAFETY_BACKOFF_FACTOR = 2
+    MAX_CONCURRENT_FETCHES = 10
+    MAX_CONCURRENT_BATCH_REVIEWS = 4
+    BLOB_CACHE_TTL = 30 * 24 * 3600
+    REVIEW_CACHE_TTL = 24 * 3600
+    REVIEW_BATCH_BYTES = 60_000
+    RATE_LIMIT_MIN_REMAINING = 10
 
-    redis_client = redis.StrictRedis(
+    redis_client = Redis(
         host=config("REDIS_HOST"),
         port=int(config("REDIS_PORT")),
-        decode_responses=True,
     )
 
     def __init__(
         self,
+        http_client: httpx.AsyncClient,
         model_name: str = "gemini-1.5-flash-001",
     ):
-        self.github_token = github_token
+        self._client = http_client
+        self._fetch_sem = asyncio.Semaphore(self.MAX_CONCURRENT_FETCHES)
         self.model = GenerativeModel(model_name=model_name)
-        vertexai.init(project=project_id, location="us-central1")
 
-    def _get_github_headers(self) -> Dict[str, str]:
-        if not self.github_token:
+    @staticmethod
+    def _get_github_headers() -> Dict[str, str]:
+        if not github_token:
             raise HTTPException(status_code=500, detail="GitHub token is not set.")
-        return {"Authorization": f"token {self.github_token}"}
+        return {"Authorization": f"token {github_token}"}
+
+    @classmethod
+    def create_http_client(cls) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            headers=cls._get_github_headers(),
+            timeout=20,
+        )
+
+    async def _wait_for_rate_limit(self, resource: str) -> None:
+        reset_time, remaining = await self.redis_client.mget(
+            f"gh:rate_reset:{resource}", f"gh:rate_remaining:{resource}"
+        )
+        sleep_time = int(reset_time or 0) - time.time()
+        if int(remaining or 5000) < self.RATE_LIMIT_MIN_REMAINING and sleep_time > 0:
+            logger.warning(
+                f"GitHub {resource} rate limit nearly exhausted. "
+                f"Sleeping for {sleep_time:.0f} seconds."
+            )
+            await asyncio.sleep(sleep_time)
+
+    @staticmethod
+    def _rate_limit_sleep(response: httpx.Response) -> Optional[float]:
+        if response.headers.get("X-RateLimit-Remaining") == "0":
+            reset_time = int(response.headers.get("X-RateLimit-Reset", 0))
+            return max(0, reset_time - time.time())
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None:
+            return float(retry_after)
+        return None
 
-    async def _get_file_content(self, file_url: str) -> Optional[str]:
+    async def _record_rate_limit(self, response: httpx.Response) -> None:
+        reset_time = response.headers.get("X-RateLimit-Reset")
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        if reset_time is None or remaining is None:
+            return
+        resource = response.headers.get("X-RateLimit-Resource", "core")
+        await self.redis_client.mset(
+            {
+                f"gh:rate_reset:{resource}": reset_time,
+                f"gh:rate_remaining:{resource}": remaining,
+            }
+        )
+
+    @staticmethod
+    def _decode_text(raw: bytes) -> Optional[str]:
+        if b"\x00" in raw:
+            return None
+        try:
+            return raw.decode("utf-8")
+        except UnicodeDecodeError:
+            return None
+
+    async def _cache_blob(self, sha: str, content: str) -> None:
+        await self.redis_client.set(
+            f"blob:{sha}",
+            _zstd_compressor.compress(content.encode("utf-8")),
+            ex=self.BLOB_CACHE_TTL,
+        )
+
+    async def _get_blob_by_sha(self, owner: str, repo: str, sha: str) -> Optional[str]:
+        file_url = f"https://api.github.com/repos/{owner}/{repo}/git/blobs/{sha}"
         attempt = 0
         while attempt < self.MAX_RETRIES:
             try:
-                async with httpx.AsyncClient() as client:
-                    response = await client.get(
-                        file_url, headers=self._get_github_headers()
+                async with self._fetch_sem:
+                    await self._wait_for_rate_limit("core")
+                    response = await self._client.get(
+                        file_url, headers={"Accept": GITHUB_RAW_MEDIA_TYPE}
                     )
-                response.raise_for_status()
+                    await self._record_rate_limit(response)
+                    response.raise_for_status()
 
-                file_data = response.json()
-                return (
-                    base64.b64decode(file_data["content"]).decode("utf-8")
-                    if "content" in file_data
-                    else None
-                )
+                    content = self._decode_text(response.content)
+                    if content is None:
+                        return None
+                    await self._cache_blob(sha, content)
+                    return content
 
             except httpx.HTTPStatusError as e:
-                if response.status_code == self.RATE_LIMIT_STATUS_CODE:
+                if (
+                    response.status_code == self.RATE_LIMIT_STATUS_CODE
+                    and (sleep_time := self._rate_limit_sleep(response)) is not None
+                ):
                     logger.warning(
                         f"Rate limit encountered (403) for {file_url}. "
-                        f"Waiting {self.BACKOFF_FACTOR} seconds before retrying."
+                        f"Waiting {sleep_time:.0f} seconds before retrying."
                     )
-                    await asyncio.sleep(self.BACKOFF_FACTOR)
+                    await asyncio.sleep(sleep_time)
                     attempt += 1
                 elif response.status_code in self.RETRY_STATUS_CODES:
                     attempt += 1
@@ -102,168 +226,334 @@ class CodeReviewService:
             status_code=500, detail="Exceeded max retries for fetching file content."
         )
 
-    async def fetch_all_files_content(
-        self, owner: str, repo: str, path: str = ""
-    ) -> Dict[str, Optional[str]]:
-        files_content = {}
-        page = 1
-
-        while True:
-            url = (
-                f"https://api.github.com/repos/{owner}/{repo}/contents/{path}"
-                f"?page={page}&per_page=100"
-            )
+    async def _request_json(
+        self, method: str, url: str, error_detail: str, **kwargs
+    ) -> Union[dict, list]:
+        attempt = 0
+        while attempt < self.MAX_RETRIES:
+            try:
+                await self._wait_for_rate_limit(
+                    "graphql" if url == GRAPHQL_URL else "core"
+                )
+                response = await self._client.request(method, url, **kwargs)
+                await self._record_rate_limit(response)
+                response.raise_for_status()
+                return response.json()
 
-            attempt = 0
-            while attempt < self.MAX_RETRIES:
-                try:
-                    async with httpx.AsyncClient() as client:
-                        response = await client.get(
-                            url, headers=self._get_github_headers()
-                        )
-                        response.raise_for_status()
-
-                        repo_content = response.json()
-                        if not repo_content:
-                            return files_content
-
-                        tasks = [
-                            self._fetch_content_recursive(
-                                item, owner, repo, files_content
-                            )
-                            for item in repo_content
-                        ]
-                        await asyncio.gather(*tasks)
-                        break
-
-                except httpx.HTTPStatusError as e:
-                    if response.status_code == self.RATE_LIMIT_STATUS_CODE:
-                        reset_time = int(response.headers.get("X-RateLimit-Reset", 0))
-                        sleep_time = max(0, reset_time - int(time.time()))
-                        logger.warning(
-                            f"Rate limit reached. Sleeping for {sleep_time} seconds."
-                        )
-                        await asyncio.sleep(sleep_time)
-                    elif response.status_code in self.RETRY_STATUS_CODES:
+            except httpx.HTTPStatusError as e:
+                if (
+                    response.status_code == self.RATE_LIMIT_STATUS_CODE
+                    and (sleep_time := self._rate_limit_sleep(response)) is not None
+                ):
+                    logger.warning(
+                        f"Rate limit reached. Sleeping for {sleep_time:.0f} seconds."
+                    )
+                    await asyncio.sleep(sleep_time)
+                    if response.headers.get("X-RateLimit-Remaining") != "0":
                         attempt += 1
-                        backoff_time = self.BACKOFF_FACTOR**attempt
-                        logger.warning(
-                            f"Retrying fetch for repository content due to status {response.status_code} "
-                            f"(Attempt {attempt}/{self.MAX_RETRIES}). Backing off for {backoff_time} seconds."
-                        )
-                        await asyncio.sleep(backoff_time)
-                    else:
-                        logger.error(
-                            f"Failed to fetch repository content from {url}: {e}"
-                        )
-                        raise HTTPException(
-                            status_code=response.status_code,
-                            detail="Failed to fetch repository content.",
-                        )
-                except Exception as e:
-                    logger.error(
-                        f"Unexpected error fetching repository content from {url}: {e}"
+                elif response.status_code in self.RETRY_STATUS_CODES:
+                    attempt += 1
+                    backoff_time = self.BACKOFF_FACTOR**attempt
+                    logger.warning(
+                        f"Retrying fetch from {url} due to status {response.status_code} "
+                        f"(Attempt {attempt}/{self.MAX_RETRIES}). Backing off for {backoff_time} seconds."
                     )
+                    await asyncio.sleep(backoff_time)
+                else:
+                    logger.error(f"Failed to fetch {url}: {e}")
                     raise HTTPException(
-                        status_code=500,
-                        detail="Unexpected error fetching repository content.",
+                        status_code=response.status_code, detail=error_detail
                     )
+            except Exception as e:
+                logger.error(f"Unexpected error fetching {url}: {e}")
+                raise HTTPException(
+                    status_code=500,
+                    detail="Unexpected error fetching repository content.",
+                )
 
-            page += 1
-            if len(repo_content) < 100:
-                break
+        raise HTTPException(
+            status_code=500,
+            detail="Exceeded max retries for fetching repository content.",
+        )
 
-        return files_content
+    async def _list_tree(
+        self, owner: str, repo: str, tree_sha: str, prefix: str = ""
+    ) -> List[Tuple[str, str]]:
+        async with self._fetch_sem:
+            tree = await self._request_json(
+                "GET",
+                f"https://api.github.com/repos/{owner}/{repo}/git/trees/{tree_sha}?recursive=1",
+                "Failed to fetch repository tree.",
+            )
+        if tree.get("truncated"):
+            logger.warning(
+                f"Tree listing for {owner}/{repo} was truncated by GitHub; "
+                f"some files will be missing from the review."
+            )
+        return [
+            (f"{prefix}{item['path']}", item["sha"])
+            for item in tree["tree"]
+            if item["type"] == "blob"
+        ]
+
+    async def get_head_sha(self, owner: str, repo: str) -> str:
+        commit = await self._request_json(
+            "GET",
+            f"https://api.github.com/repos/{owner}/{repo}/commits/HEAD",
+            "Failed to fetch repository HEAD commit.",
+        )
+        return commit["sha"]
 
-    async def _fetch_content_recursive(
-        self, item: dict, owner: str, repo: str, files_content: Dict[str, Optional[str]]
+    async def _graphql(self, query: str, variables: dict) -> dict:
+        result = await self._request_json(
+            "POST",
+            GRAPHQL_URL,
+            "Failed to fetch repository content.",
+            json={"query": query, "variables": variables},
+        )
+        errors = result.get("errors") or []
+        if any(error.get("type") == "NOT_FOUND" for error in errors):
+            raise HTTPException(status_code=404, detail="Repository not found.")
+        if errors:
+            logger.error(f"GraphQL errors for {variables}: {errors}")
+            raise HTTPException(
+                status_code=500, detail="Failed to fetch repository content."
+            )
+        return result["data"]
+
+    async def _fetch_tree_via_graphql(
+        self, owner: str, repo: str, ref: str
+    ) -> Tuple[Dict[str, Optional[str]], List[Tuple[str, str]], List[Tuple[str, str]]]:
+        data = await self._graphql(
+            GRAPHQL_TREE_QUERY, {"owner": owner, "name": repo, "expression": f"{ref}:"}
+        )
+        files_content = {}
+        pending_blobs = []
+        pending_trees = []
+        root = (data["repository"] or {}).get("object") or {}
+        self._collect_graphql_entries(
+            root.get("entries", []), files_content, pending_blobs, pending_trees
+        )
+        return files_content, pending_blobs, pending_trees
+
+    def _collect_graphql_entries(
+        self,
+        entries: list,
+        files_content: Dict[str, Optional[str]],
+        pending_blobs: List[Tuple[str, str]],
+        pending_trees: List[Tuple[str, str]],
     ) -> None:
-        if item["type"] == "file":
-            file_content = await self._get_file_content(item["url"])
-            files_content[item["path"]] = file_content
-        elif item["type"] == "dir":
-            subdir_content = await self.fetch_all_files_content(
-                owner, repo, item["path"]
+        for entry in entries:
+            path = entry["path"]
+            obj = entry["object"] or {}
+            if entry["type"] == "tree":
+                if entry["path"].rsplit("/", 1)[-1] in SKIP_DIRS:
+                    continue
+                if "entries" in obj:
+                    self._collect_graphql_entries(
+                        obj["entries"], files_content, pending_blobs, pending_trees
+                    )
+                else:
+                    pending_trees.append((path, entry["oid"]))
+            elif entry["type"] == "blob" and not self._is_skipped(path):
+                files_content[path] = None
+                if not obj.get("isBinary"):
+                    pending_blobs.append((path, entry["oid"]))
+
+    async def _fetch_blob_texts(
+        self, owner: str, repo: str, oids: List[str]
+    ) -> Dict[str, Optional[str]]:
+        async with self._fetch_sem:
+            data = await self._graphql(
+                _build_blob_text_query(oids), {"owner": owner, "name": repo}
             )
-            files_content.update(subdir_content)
+        objects = data["repository"] or {}
+        texts = {}
+        truncated = []
+        for index, oid in enumerate(oids):
+            obj = objects.get(f"b{index}") or {}
+            if obj.get("isTruncated") and not obj.get("isBinary"):
+                truncated.append(oid)
+            else:
+                texts[oid] = None if obj.get("isBinary") else obj.get("text")
+
+        async with self._fetch_sem:
+            for oid, text in texts.items():
+                if text is not None:
+                    await self._cache_blob(oid, text)
+
+        fetched = await self._run_all(
+            self._get_blob_by_sha(owner, repo, oid) for oid in truncated
+        )
+        texts.update(zip(truncated, fetched))
+        return texts
+
+    async def _get_blobs(
+        self, owner: str, repo: str, shas: List[str]
+    ) -> Dict[str, Optional[str]]:
+        if not shas:
+            return {}
+
+        cached_bodies = await self.redis_client.mget([f"blob:{sha}" for sha in shas])
+        contents = {}
+        misses = []
+        for sha, body in zip(shas, cached_bodies):
+            if body is None:
+                misses.append(sha)
+                continue
+            try:
+                contents[sha] = _zstd_decompressor.decompress(body).decode("utf-8")
+            except zstd.ZstdError:
+                misses.append(sha)
+
+        for texts in await self._run_all(
+            self._fetch_blob_texts(owner, repo, misses[i : i + GRAPHQL_BLOB_BATCH])
+            for i in range(0, len(misses), GRAPHQL_BLOB_BATCH)
+        ):
+            contents.update(texts)
+        return contents
+
+    @staticmethod
+    async def _run_all(coros: Iterable[Awaitable[T]]) -> List[T]:
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tasks = [tg.create_task(coro) for coro in coros]
+        except ExceptionGroup as group:
+            raise group.exceptions[0] from None
+        return [task.result() for task in tasks]
+
+    @staticmethod
+    def _is_skipped(path: str) -> bool:
+        *dirs, name = path.split("/")
+        return not SKIP_DIRS.isdisjoint(dirs) or name.lower().endswith(SKIP_EXT)
+
+    async def fetch_all_files_content(
+        self, owner: str, repo: str, ref: str = "HEAD"
+    ) -> Dict[str, Optional[str]]:
+        files_content, blobs, trees = await self._fetch_tree_via_graphql(
+            owner, repo, ref
+        )
+        subtrees = await self._run_all(
+            self._list_tree(owner, repo, tree_sha, prefix=f"{tree_path}/")
+            for tree_path, tree_sha in trees
+        )
+        for subtree in subtrees:
+            for path, sha in subtree:
+                if not self._is_skipped(path):
+                    files_content[path] = None
+                    blobs.append((path, sha))
+
+        contents = await self._get_blobs(
+            owner, repo, list(dict.fromkeys(sha for _, sha in blobs))
+        )
+        files_content.update((path, contents[sha]) for path, sha in blobs)
+        return files_content
 
     @staticmethod
     def build_file_structure(files: list) -> Dict[str, Union[None, dict]]:
         file_tree = {}
         for file_path in files:
-            parts = file_path.split("/")
+            *dirs, name = file_path.split("/")
             current_level = file_tree
-            for part in parts:
-                if part not in current_level:
-                    current_level[part] = {} if part != parts[-1] else None
-                current_level = (
-                    current_level[part]
-                    if current_level[part] is not None
-                    else current_level
-                )
+            for part in dirs:
+                next_level = current_level.setdefault(part, {})
+                if next_level is None:
+                    next_level = current_level[part] = {}
+                current_level = next_level
+            current_level.setdefault(name, None)
         return file_tree
 
     @classmethod
-    def cache_result(cls, key: str, value: dict, ttl: int = 3600) -> None:
-        cls.redis_client.set(key, json.dumps(value), ex=ttl)
+    async def cache_result(cls, key: str, value: dict, ttl: int = 3600) -> None:
+        await cls.redis_client.set(
+            key, _zstd_compressor.compress(orjson.dumps(value)), ex=ttl
+        )
 
     @classmethod
-    def get_cached_result(cls, key: str) -> Optional[dict]:
-        cached_data = cls.redis_client.get(key)
-        return json.loads(cached_data) if cached_data else None
+    async def get_cached_result(cls, key: str) -> Optional[dict]:
+        cached_data = await cls.redis_client.get(key)
+        if not cached_data:
+            return None
+        try:
+            return orjson.loads(_zstd_decompressor.decompress(cached_data))
+        except zstd.ZstdError:
+            logger.warning(f"Ignoring undecodable cache entry {key}.")
+            return None
 
     @staticmethod
     def parse_review_response(
         response_text: str, found_files: FileTreeModel
     ) -> ReviewResponseModel:
-        downsides_comments = re.search(
-            r"### Downsides:\n(.*?)(?=\n###|$)", response_text, re.DOTALL
-        )
-        rating = re.search(r"### Rating:\n(.*?)(?=\n###|$)", response_text, re.DOTALL)
-        conclusion = re.search(
-            r"### Conclusion:\n(.*?)(?=\n###|$)", response_text, re.DOTALL
-        )
+        sections = {}
+        for match in REVIEW_SECTION_RE.finditer(response_text):
+            sections.setdefault(match.group("section"), match.group("body").strip())
 
         return ReviewResponseModel(
-            found_files=FileTreeModel.parse_obj(found_files),
-            downsides_comments=(
-                downsides_comments.group(1).strip() if downsides_comments else ""
-            ),
-            rating=rating.group(1).strip() if rating else "",
-            conclusion=conclusion.group(1).strip() if conclusion else "",
+            found_files=FileTreeModel.model_validate(found_files),
+            downsides_comments=sections.get("Downsides", ""),
+            rating=sections.get("Rating", ""),
+            conclusion=sections.get("Conclusion", ""),
         )
 
-    async def generate_review(
-        self, files_content: Dict[str, Optional[str]], candidate_level: str
-    ) -> ReviewResponseModel:
-        file_structure = self.build_file_structure(list(files_content.keys()))
-        code_snippets = "\n".join(
-            [
-                f"File: {filename}\n{content}"
-                for filename, content in files_content.items()
-            ]
-        )
+    @staticmethod
+    def _format_code_snippets(files_content: Dict[str, Optional[str]]) -> str:
+        buffer = io.StringIO()
+        for filename, content in files_content.items():
+            buffer.write("File: ")
+            buffer.write(filename)
+            buffer.write("\n")
+            if content:
+                buffer.write(content)
+            buffer.write("\n")
+        return buffer.getvalue()
 
-        prompt = (
-            f"Review this code for a {candidate_level} level assignment.\n\n"
-            f"Files found in the repository:\n{file_structure}\n\n"
-            f"Code snippets:\n{code_snippets}\n\n"
-            "Provide feedback exactly in the following format, ensuring each section starts with the specified label:\n"
-            "### Start of Review\n"
-            "### Downsides:\n- List any issues or missing features in the code.\n\n"
-            "### Rating:\n- Provide a rating out of 5 and briefly justify the score.\n\n"
-            "### Conclusion:\n- Summarize the main points and give recommendations for improvements.\n"
-            "### End of Review"
-        )
+    @staticmethod
+    def _batch_files(
+        files_content: Dict[str, Optional[str]], budget: int
+    ) -> List[Dict[str, Optional[str]]]:
+        batches = []
+        batch = {}
+        batch_size = 0
+        for filename in sorted(files_content, key=lambda path: path.rpartition("/")[0]):
+            content = files_content[filename]
+            size = len(content or "")
+            if batch and batch_size + size > budget:
+                batches.append(batch)
+                batch = {}
+                batch_size = 0
+            batch[filename] = content
+            batch_size += size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    @staticmethod
+    def _split_bullet_blocks(text: str) -> List[str]:
+        blocks = []
+        for line in text.splitlines():
+            if TOP_LEVEL_BULLET_RE.match(line) or not blocks:
+                blocks.append([])
+            blocks[-1].append(line.rstrip())
+        return ["\n".join(block).strip("\n") for block in blocks]
+
+    @classmethod
+    def _merge_downsides(cls, reviews: List[ReviewResponseModel]) -> str:
+        blocks = {}
+        for review in reviews:
+            for block in cls._split_bullet_blocks(review.downsides_comments):
+                if block:
+                    blocks.setdefault(block, None)
+        return "\n".join(blocks)
 
+    async def _generate_text(self, prompt: str) -> str:
         safety_attempt = 0
         while safety_attempt < self.SAFETY_RETRY_LIMIT:
             try:
-                response = self.model.generate_content(prompt)
+                response = await self.model.generate_content_async(prompt)
                 if (
                     not response
-                    or not hasattr(response, "text")
-                    or response.candidates[0].finish_reason == "SAFETY"
+                    or not response.candidates
+                    or response.candidates[0].finish_reason == FinishReason.SAFETY
                 ):
                     logger.warning(
                         f"Safety filter triggered on attempt {safety_attempt + 1}. "
@@ -274,10 +564,7 @@ class CodeReviewService:
                     await asyncio.sleep(backoff_time)
                     continue
 
-                response_text = response.text
-                return self.parse_review_response(
-                    response_text, FileTreeModel.parse_obj(file_structure)
-                )
+                return response.text
 
             except Exception as e:
                 logger.error(f"An error occurred while generating the review: {e}")
@@ -290,3 +577,61 @@ class CodeReviewService:
             status_code=400,
             detail="Review generation blocked by safety filters after multiple attempts.",
         )
+
+    async def generate_review(
+        self, files_content: Dict[str, Optional[str]], candidate_level: str
+    ) -> ReviewResponseModel:
+        file_structure = self.build_file_structure(list(files_content.keys()))
+        found_files = FileTreeModel.model_validate(file_structure)
+        batches = self._batch_files(files_content, self.REVIEW_BATCH_BYTES) or [{}]
+
+        prompts = [
+            (
+                f"Review this code for a {candidate_level} level assignment.\n\n"
+                f"Files found in the repository:\n{self.build_file_structure(list(batch))}\n\n"
+                f"Code snippets:\n{self._format_code_snippets(batch)}\n\n"
+                "Provide feedback exactly in the following format, ensuring each section starts with the specified label:\n"
+                "### Start of Review\n"
+                "### Downsides:\n- List any issues or missing features in the code.\n\n"
+                "### Rating:\n- Provide a rating out of 5 and briefly justify the score.\n\n"
+                "### Conclusion:\n- Summarize the main points and give recommendations for improvements.\n"
+                "### End of Review"
+            )
+            for batch in batches
+        ]
+        batch_sem = asyncio.Semaphore(self.MAX_CONCURRENT_BATCH_REVIEWS)
+
+        async def review_batch(prompt: str) -> str:
+            async with batch_sem:
+                return await self._generate_text(prompt)
+
+        responses = await self._run_all(review_batch(p) for p in prompts)
+        reviews = [
+            self.parse_review_response(response_text, found_files)
+            for response_text in responses
+        ]
+        if len(reviews) == 1:
+            return reviews[0]
+
+        downsides_comments = self._merge_downsides(reviews)
+        partial_reviews = "\n\n".join(
+            f"Part {index}:\nRating: {review.rating}\nConclusion: {review.conclusion}"
+            for index, review in enumerate(reviews, start=1)
+        )
+        summary_text = await self._generate_text(
+            f"A {candidate_level} level assignment was reviewed in {len(reviews)} parts.\n\n"
+            f"Files found in the repository:\n{file_structure}\n\n"
+            f"Combined downsides:\n{downsides_comments}\n\n"
+            f"Partial reviews:\n{partial_reviews}\n\n"
+            "Consolidate them exactly in the following format, ensuring each section starts with the specified label:\n"
+            "### Rating:\n- Provide a single overall rating out of 5 and briefly justify the score.\n\n"
+            "### Conclusion:\n- Summarize the main points and give recommendations for improvements.\n"
+            "### End of Review"
+        )
+        summary = self.parse_review_response(summary_text, found_files)
+        return ReviewResponseModel(
+            found_files=found_files,
+            downsides_comments=downsides_comments,
+            rating=summary.rating,
+            conclusion=summary.conclusion,
+        )